@@ -1,110 +1,220 @@
+import numexpr as ne
 import numpy as np
+from numba import get_num_threads, njit, prange
+
+# Scratch memory reused across calls, keyed by name. Arrays handed out by
+# _get_buffer are overwritten by the next call asking for the same name, so
+# they must be consumed before that happens. Not thread safe.
+_BUFFERS = {}
+
+# Number of joint probabilities exact_batch and batch_sample materialise at once.
+_JOINT_BLOCK_SIZE = 1 << 18
+
+
+def _block_rows(M, C):
+    # The entropy kernels prange over the rows of a block, so a block holds
+    # a whole number of rows per thread, at least one even when M * C alone
+    # exceeds the budget.
+    threads = get_num_threads()
+    rows = max(1, _JOINT_BLOCK_SIZE // (M * C))
+    return -(-rows // threads) * threads
+
+
+def _get_buffer(name, shape, dtype=np.float64):
+    size = int(np.prod(shape))
+    buf = _BUFFERS.get(name)
+    if buf is None or buf.dtype != dtype or buf.size < size:
+        buf = np.empty(size, dtype=dtype)
+        _BUFFERS[name] = buf
+    # A prefix of the flat storage keeps the returned view C-contiguous.
+    return buf[:size].reshape(shape)
 
 ## Conditional Entropy
 def compute_conditional_entropies_B(probs_B_K_C):
     B, K, C = probs_B_K_C.shape
-    return np.sum(-1*probs_B_K_C * np.log(probs_B_K_C), axis=(1, 2)) / K
+    # where() makes 0 * log(0) contribute 0 instead of nan.
+    nats_B_K_C = ne.evaluate('where(probs_B_K_C > 0, -probs_B_K_C * log(probs_B_K_C), 0)')
+    entropy_B = nats_B_K_C.sum(axis=(1, 2))
+    entropy_B *= 1. / K
+    return entropy_B
 
 
 ## Exact Methods
+@njit(parallel=True, cache=True, fastmath=True)
+def _expand_step(prev_M_K, probs_K_C, out_MC_K):
+    M, K = prev_M_K.shape
+    C = probs_K_C.shape[1]
+    for m in prange(M):
+        for c in range(C):
+            for k in range(K):
+                out_MC_K[m * C + c, k] = prev_M_K[m, k] * probs_K_C[k, c]
+
+
+# Binary classification is the common case: with C == 2 every step writes
+# two contiguous rows from two contiguous class columns.
+@njit(parallel=True, cache=True, fastmath=True)
+def _expand_step_C2(prev_M_K, probs0_K, probs1_K, out_2M_K):
+    M, K = prev_M_K.shape
+    for m in prange(M):
+        for k in range(K):
+            out_2M_K[2 * m, k] = prev_M_K[m, k] * probs0_K[k]
+        for k in range(K):
+            out_2M_K[2 * m + 1, k] = prev_M_K[m, k] * probs1_K[k]
+
+
 def joint_probs_M_K_impl(probs_N_K_C, prev_joint_probs_M_K):
     assert prev_joint_probs_M_K.shape[1] == probs_N_K_C.shape[1]
 
     N, K, C = probs_N_K_C.shape
-    prev_joint_probs_K_M_1 = prev_joint_probs_M_K.transpose()[:, :, None]
+    M = prev_joint_probs_M_K.shape[0]
+    # K stays the last (contiguous) axis throughout, so no transposes are needed.
+    prev_joint_probs_M_K = np.ascontiguousarray(prev_joint_probs_M_K)
 
     # Exponential memory consumption. Increases by a factor of C each iteration.
+    # Steps alternate between two buffers allocated once, sized so that the
+    # last step lands in the larger one. They are private to this call since
+    # the result is handed back (and often fed in again) by the caller.
+    buffers = [np.empty(M * C ** N * K, dtype=prev_joint_probs_M_K.dtype)]
+    if N > 1:
+        buffers.append(np.empty(M * C ** (N - 1) * K, dtype=prev_joint_probs_M_K.dtype))
+
     for i in range(N):
-        i_K_1_C = probs_N_K_C[i][:, None, :]
-        joint_probs_K_M_C = prev_joint_probs_K_M_1 * i_K_1_C
-        prev_joint_probs_K_M_1 = joint_probs_K_M_C.reshape((K, -1, 1))
+        buf = buffers[(N - 1 - i) % 2]
+        joint_probs_MC_K = buf[:M * C * K].reshape((M * C, K))
+        if C == 2:
+            _expand_step_C2(prev_joint_probs_M_K,
+                            np.ascontiguousarray(probs_N_K_C[i, :, 0]),
+                            np.ascontiguousarray(probs_N_K_C[i, :, 1]),
+                            joint_probs_MC_K)
+        else:
+            _expand_step(prev_joint_probs_M_K, np.ascontiguousarray(probs_N_K_C[i]),
+                         joint_probs_MC_K)
+        prev_joint_probs_M_K = joint_probs_MC_K
+        M *= C
 
-    prev_joint_probs_M_K = prev_joint_probs_K_M_1.squeeze(2).transpose()
     return prev_joint_probs_M_K
 
 
-def joint_probs_M_K(probs_N_K_C, prev_joint_probs_M_K=None):
+# Probabilities are processed in float32 by default: it halves the memory
+# traffic and is precise enough for ranking acquisitions. Sums over the
+# joint entries are still accumulated in float64.
+def joint_probs_M_K(probs_N_K_C, prev_joint_probs_M_K=None, dtype=np.float32):
     if prev_joint_probs_M_K is not None:
         assert prev_joint_probs_M_K.shape[1] == probs_N_K_C.shape[1]
 
     N, K, C = probs_N_K_C.shape
     if prev_joint_probs_M_K is None:
-        prev_joint_probs_M_K = np.ones((1, K), dtype=np.float64)
-    return joint_probs_M_K_impl(probs_N_K_C, prev_joint_probs_M_K)
+        prev_joint_probs_M_K = np.ones((1, K), dtype=dtype)
+    return joint_probs_M_K_impl(probs_N_K_C.astype(dtype, copy=False),
+                                prev_joint_probs_M_K.astype(dtype, copy=False))
 
 
 def entropy_from_M_K(joint_probs_M_K):
-    probs_M = np.mean(joint_probs_M_K, axis=1, keepdims=False)
-    nats_M = -np.log(probs_M) * probs_M
-    entropy = np.sum(nats_M)
+    # Row sums accumulate in float64 even for float32 joint probabilities.
+    probs_M = joint_probs_M_K.sum(axis=1, dtype=np.float64)
+    probs_M *= 1. / joint_probs_M_K.shape[1]
+    # One fused numexpr reduction; 0 * log(0) contributes 0.
+    entropy = ne.evaluate('sum(where(p > 0, -log(p) * p, 0))',
+                          local_dict={'p': probs_M})[()]
     return entropy
 
+@njit(parallel=True, cache=True, fastmath=True)
+def _entropy_p_b_M_C(p_b_M_C, out_b):
+    b, M, C = p_b_M_C.shape
+    # Every iteration writes its own element of out_b, so prange is race free.
+    for i in prange(b):
+        nats = 0.
+        for m in range(M):
+            for c in range(C):
+                x = p_b_M_C[i, m, c]
+                # Low precision joint probabilities can underflow to 0.
+                if x > 0.:
+                    nats -= np.log(x) * x
+        out_b[i] = nats
+
+
 def entropy_from_probs_b_M_C(probs_b_M_C):
-    return np.sum(-probs_b_M_C * np.log(probs_b_M_C), axis=(1, 2))
+    entropy_b = np.empty((probs_b_M_C.shape[0],), dtype=np.float64)
+    _entropy_p_b_M_C(np.ascontiguousarray(probs_b_M_C), entropy_b)
+    return entropy_b
 
 
-def exact_batch(probs_B_K_C, prev_joint_probs_M_K=None):
+def exact_batch(probs_B_K_C, prev_joint_probs_M_K=None, dtype=np.float32):
     if prev_joint_probs_M_K is not None:
         assert prev_joint_probs_M_K.shape[1] == probs_B_K_C.shape[1]
 
     B, K, C = probs_B_K_C.shape
 
     if prev_joint_probs_M_K is None:
-        prev_joint_probs_M_K = np.ones((1, K), dtype=np.float64)
-
-    joint_probs_B_M_C = entropy_joint_probs_B_M_C(probs_B_K_C, prev_joint_probs_M_K)
+        prev_joint_probs_M_K = np.ones((1, K), dtype=dtype)
 
-    # Now we can compute the entropy.
-    entropy_B = np.zeros((B,), dtype=np.float64)
+    # The joint probabilities are produced and reduced a block of rows at a
+    # time, so only a (b, M, C) block is ever materialised instead of the
+    # full (B, M, C) array.
+    M = prev_joint_probs_M_K.shape[0]
+    chunk_size = _block_rows(M, C)
+    prev_joint_probs_M_K = prev_joint_probs_M_K.astype(dtype, copy=False)
+    probs_B_K_C = probs_B_K_C.astype(dtype, copy=False)
 
-    chunk_size = 256
-    for i in range(0, B, chunk_size):
-        end_i = i+chunk_size
-        entropy_B[i:end_i] = entropy_from_probs_b_M_C(joint_probs_B_M_C[i:end_i])
+    entropy_B = np.empty((B,), dtype=np.float64)
+    for probs_b_K_C, entropy_b in split_arrays(probs_B_K_C, entropy_B, chunk_size):
+        joint_probs_b_M_C = _entropy_joint_probs_b_M_C(probs_b_K_C, prev_joint_probs_M_K,
+                                                       dtype=dtype)
+        _entropy_p_b_M_C(joint_probs_b_M_C, entropy_b)
 
     return entropy_B
 
 # Not computing an Entropy
-def entropy_joint_probs_B_M_C(probs_B_K_C, prev_joint_probs_M_K):
+def entropy_joint_probs_B_M_C(probs_B_K_C, prev_joint_probs_M_K, dtype=np.float32):
     B, K, C = probs_B_K_C.shape
-    M = prev_joint_probs_M_K.shape[0]
-    joint_probs_B_M_C = np.empty((B, M, C), dtype=np.float64)
-
-    for i in range(B):
-        np.matmul(prev_joint_probs_M_K, probs_B_K_C[i], out=joint_probs_B_M_C[i])
 
-    joint_probs_B_M_C /= K
+    # Single batched GEMM: the (M, K) operand broadcasts over the B axis.
+    joint_probs_B_M_C = np.matmul(prev_joint_probs_M_K.astype(dtype, copy=False),
+                                  probs_B_K_C.astype(dtype, copy=False))
+    joint_probs_B_M_C *= 1. / K
     return joint_probs_B_M_C
 
+# Same as entropy_joint_probs_B_M_C for one block of rows, written into a
+# shared scratch buffer which the next call overwrites.
+def _entropy_joint_probs_b_M_C(probs_b_K_C, prev_joint_probs_M_K, dtype=np.float32):
+    b, K, C = probs_b_K_C.shape
+    M = prev_joint_probs_M_K.shape[0]
+    joint_probs_b_M_C = _get_buffer('joint_probs_b_M_C', (b, M, C), dtype=dtype)
+
+    np.matmul(prev_joint_probs_M_K, probs_b_K_C, out=joint_probs_b_M_C)
+    joint_probs_b_M_C *= 1. / K
+    return joint_probs_b_M_C
+
 def split_arrays(arr1, arr2, chunk_size):
+    # Checked on the call, not when iteration starts.
     assert arr1.shape[0] == arr2.shape[0]
-    arrays = []
-    for i in range(0, arr1.shape[0], chunk_size):
-        end_i = i+chunk_size
-        arrays.append((arr1[i:end_i], arr2[i:end_i]))
-    return arrays
+    # Yields matching chunks lazily; slices are views so nothing is copied.
+    return ((arr1[i:i+chunk_size], arr2[i:i+chunk_size])
+            for i in range(0, arr1.shape[0], chunk_size))
 
 ## Sampling approaches
-def sample_M_K(probs_N_K_C, S=1000):
+def sample_M_K(probs_N_K_C, S=1000, rng=None):
     K = probs_N_K_C.shape[1]
 
-    choices_N_K_S = fast_multi_choices(probs_N_K_C, S)
+    choices_N_K_S = fast_multi_choices(probs_N_K_C, S, rng=rng)
 
     expanded_choices_N_K_K_S = choices_N_K_S[:, None, :, :]
     expanded_probs_N_K_K_C = probs_N_K_C[:, :, None, :]
 
     probs_N_K_K_S = take_expand(expanded_probs_N_K_K_C, index=expanded_choices_N_K_K_S, dim=-1)
-    # exp sum log seems necessary to avoid 0s?
-    probs_K_K_S = np.exp(np.sum(np.log(probs_N_K_K_S), axis=0, keepdims=False))
+    # A plain product: exp(sum(log)) underflows to 0 exactly where the product does.
+    probs_K_K_S = np.prod(probs_N_K_K_S, axis=0)
     samples_K_M = probs_K_K_S.reshape((K, -1))
 
     samples_M_K = samples_K_M.transpose()
     return samples_M_K
 
 def from_M_K(samples_M_K):
-    probs_M = np.mean(samples_M_K, axis=1, keepdims=False)
-    nats_M = -np.log(probs_M)
-    entropy = np.mean(nats_M)
+    M, K = samples_M_K.shape
+    probs_M = samples_M_K.sum(axis=1)
+    probs_M *= 1. / K
+    nats_M = np.log(probs_M, out=probs_M)
+    entropy = -nats_M.sum() * (1. / M)
     return entropy
 
 
@@ -116,53 +226,92 @@ def take_expand(data, index, dim):
     new_index_shape = list(max_shape)
     new_index_shape[dim] = index.shape[dim]
 
-
-    data = data.repeat(new_data_shape[2], axis=2)
-    index = index.repeat(new_index_shape[1], axis=1)
+    # broadcast_to returns zero-stride views, so nothing is copied before the gather.
+    data = np.broadcast_to(data, new_data_shape)
+    index = np.broadcast_to(index, new_index_shape)
 
     return np.take_along_axis(data, index, axis=dim)
 
-def fast_multi_choices(probs_b_C, M):
+@njit(parallel=True, cache=True, fastmath=True)
+def _search_choices(cdf_B_C, r_B_M, out_B_M):
+    B, M = r_B_M.shape
+    for b in prange(B):
+        for m in range(M):
+            # Number of CDF entries <= r, i.e. the index of the sampled class.
+            out_B_M[b, m] = np.searchsorted(cdf_B_C[b], r_B_M[b, m], side='right')
+
+
+def fast_multi_choices(probs_b_C, M, rng=None):
+    if rng is None:
+        # Seeded from the legacy global state, so np.random.seed keeps the
+        # sampling reproducible for callers which don't pass a Generator.
+        rng = np.random.Generator(np.random.PCG64DXSM(
+            np.random.randint(np.iinfo(np.int64).max, dtype=np.int64)))
+
     probs_B_C = probs_b_C.reshape((-1, probs_b_C.shape[-1]))
-    s = probs_B_C.cumsum(axis=1).repeat(M, axis=0)
+    s = probs_B_C.cumsum(axis=1)
     # Probabilities might not sum to 1. perfectly due to numerical errors.
     s[:, -1] = 1.
-    r = np.random.rand(probs_B_C.shape[0] * M)[:, np.newaxis]
-    choices = (s <= r).sum(axis=1)
+    r = rng.random((probs_B_C.shape[0], M))
+    choices = np.empty(r.shape, dtype=np.int64)
+    _search_choices(s, r, choices)
     choices_b_M = choices.reshape(probs_b_C.shape[:-1] + (M,))
     return choices_b_M
 
-def batch_sample(probs_B_K_C, samples_M_K):
-    probs_B_K_C = probs_B_K_C
-    samples_M_K = samples_M_K
-
+def batch_sample(probs_B_K_C, samples_M_K, dtype=np.float32):
     M, K = samples_M_K.shape
     B, K_, C = probs_B_K_C.shape
     assert K == K_
 
-    p_B_M_C = np.empty((B, M, C), dtype=np.float64)
+    samples_M_K = samples_M_K.astype(dtype, copy=False)
+    probs_B_K_C = probs_B_K_C.astype(dtype, copy=False)
 
-    for i in range(B):
-        np.matmul(samples_M_K, probs_B_K_C[i], out=p_B_M_C[i])
+    q_1_M_1 = samples_M_K.sum(axis=1, keepdims=True)[None]
+    q_1_M_1 *= 1. / K
+    inv_q_M = _inverse_q_M(q_1_M_1)
 
-    p_B_M_C /= K
+    # Blocked like exact_batch, so the scratch holds only a (b, M, C) block
+    # and not the full (B, M, C) array.
+    chunk_size = _block_rows(M, C)
 
-    q_1_M_1 = samples_M_K.mean(axis=1, keepdims=True)[None]
+    entropy_B = np.empty((B,), dtype=np.float64)
+    for probs_b_K_C, entropy_b in split_arrays(probs_B_K_C, entropy_B, chunk_size):
+        p_b_M_C = _get_buffer('p_b_M_C', (probs_b_K_C.shape[0], M, C), dtype=dtype)
+        np.matmul(samples_M_K, probs_b_K_C, out=p_b_M_C)
+        p_b_M_C *= 1. / K
+        _importance_weighted_entropy_p_b_M_C(p_b_M_C, inv_q_M, entropy_b)
 
-    # Now we can compute the entropy.
-    # We store it directly on the CPU to save GPU memory.
-    entropy_B = np.zeros((B,), dtype=np.float64)
-
-#     chunk_size = 256
-#     for entropy_b, p_b_M_C in split_tensors(entropy_B, p_B_M_C, chunk_size):
-#         entropy_b.copy_(importance_weighted_entropy_p_b_M_C(p_b_M_C, q_1_M_1, M), non_blocking=True)
+    entropy_B *= 1. / M
+    return entropy_B
 
-    chunk_size = 256
-    for i in range(0, B, chunk_size):
-        end_i = i+chunk_size
-        entropy_B[i:end_i] = importance_weighted_entropy_p_b_M_C(p_B_M_C[i:end_i], q_1_M_1, M)
+@njit(parallel=True, cache=True, fastmath=True)
+def _importance_weighted_entropy_p_b_M_C(p_b_M_C, inv_q_M, out_b):
+    b, M, C = p_b_M_C.shape
+    for i in prange(b):
+        nats = 0.
+        for m in range(M):
+            nats_m = 0.
+            for c in range(C):
+                x = p_b_M_C[i, m, c]
+                if x > 0.:
+                    nats_m -= np.log(x) * x
+            nats += nats_m * inv_q_M[m]
+        out_b[i] = nats
+
+
+def _inverse_q_M(q_1_M_1):
+    # Divide once per m here instead of once per (b, m) in the kernel.
+    # q_M[m] == 0 only if the sample underflowed, and then p_b_M_C[:, m] == 0 too.
+    # Inverted in float64: 1 / q overflows float32 for subnormal q.
+    q_M = q_1_M_1.reshape(-1).astype(np.float64)
+    inv_q_M = np.zeros(q_M.shape, dtype=np.float64)
+    np.divide(1., q_M, out=inv_q_M, where=q_M > 0)
+    return inv_q_M
 
-    return entropy_B
 
 def importance_weighted_entropy_p_b_M_C(p_b_M_C, q_1_M_1, M: int):
-    return np.sum(-np.log(p_b_M_C) * p_b_M_C / q_1_M_1, axis=(1, 2)) / M
+    entropy_b = np.empty((p_b_M_C.shape[0],), dtype=np.float64)
+    _importance_weighted_entropy_p_b_M_C(np.ascontiguousarray(p_b_M_C),
+                                         _inverse_q_M(q_1_M_1), entropy_b)
+    entropy_b *= 1. / M
+    return entropy_b
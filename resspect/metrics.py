@@ -15,6 +15,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import numpy as np
 import pandas as pd
 
 
@@ -22,6 +23,68 @@ __all__ = ['efficiency', 'purity', 'fom', 'accuracy', 'get_snpcc_metric',
            'cosmo_metric', 'get_cosmo_metric']
 
 
+def _classification_counts(label_pred: list, label_true: list, ia_flag=1):
+    """Count the classification outcomes used by the SNPCC metrics.
+
+    Parameters
+    ----------
+    label_pred: list
+        Predicted labels
+    label_true: list
+        True labels
+    ia_flag: int (optional)
+        Flag used to identify Ia objects. Default is 1.
+
+    Returns
+    -------
+    cc: int
+        Number of correct classifications.
+    cc_ia: int
+        Number of correctly classified SN Ia.
+    wr_nia: int
+        Number of non-Ia wrongly classified.
+    tot_ia: int
+        Total number of SN Ia.
+    """
+
+    pred = np.asarray(label_pred)
+    true = np.asarray(label_true)
+
+    correct = pred == true
+    true_ia = true == ia_flag
+
+    # Plain ints, so e.g. a sample without SN Ia raises ZeroDivisionError
+    # as the list based counts did instead of returning nan.
+    cc = int(correct.sum())
+    cc_ia = int((correct & true_ia).sum())
+    wr_nia = int((~correct & ~true_ia).sum())
+    tot_ia = int(true_ia.sum())
+
+    return cc, cc_ia, wr_nia, tot_ia
+
+
+def _accuracy(cc: int, tot: int):
+    return cc / tot
+
+
+def _efficiency(cc_ia: int, tot_ia: int):
+    return float(cc_ia) / tot_ia
+
+
+def _purity(cc_ia: int, wr_nia: int):
+    if cc_ia + wr_nia > 0:
+        return float(cc_ia) / (cc_ia + wr_nia)
+    else:
+        return 0
+
+
+def _fom(cc_ia: int, wr_nia: int, tot_ia: int, penalty: float):
+    if (cc_ia + penalty * wr_nia) > 0:
+        return (float(cc_ia) / (cc_ia + penalty * wr_nia)) * float(cc_ia) / tot_ia
+    else:
+        return 0
+
+
 def efficiency(label_pred: list, label_true: list, ia_flag=1):
     """Calculate efficiency.
 
@@ -41,10 +104,9 @@ def efficiency(label_pred: list, label_true: list, ia_flag=1):
 
     """
 
-    cc_ia = sum([label_pred[i] == label_true[i] and label_true[i] == ia_flag for i in range(len(label_pred))])
-    tot_ia = sum([label_true[i] == ia_flag for i in range(len(label_true))])
+    _, cc_ia, _, tot_ia = _classification_counts(label_pred, label_true, ia_flag)
 
-    return float(cc_ia) / tot_ia
+    return _efficiency(cc_ia, tot_ia)
 
 
 def purity(label_pred: list, label_true: list, ia_flag=1):
@@ -66,13 +128,9 @@ def purity(label_pred: list, label_true: list, ia_flag=1):
 
     """
 
-    cc_ia = sum([label_pred[i] == label_true[i] and label_true[i] == ia_flag for i in range(len(label_pred))])
-    wr_nia = sum([label_pred[i] != label_true[i] and label_true[i] != ia_flag for i in range(len(label_pred))])
+    _, cc_ia, wr_nia, _ = _classification_counts(label_pred, label_true, ia_flag)
 
-    if cc_ia + wr_nia > 0:
-        return float(cc_ia) / (cc_ia + wr_nia)
-    else:
-        return 0
+    return _purity(cc_ia, wr_nia)
 
 
 def fom(label_pred: list, label_true: list, ia_flag=1, penalty=3.0):
@@ -97,14 +155,9 @@ def fom(label_pred: list, label_true: list, ia_flag=1, penalty=3.0):
 
     """
 
-    cc_ia = sum([label_pred[i] == label_true[i] and label_true[i] == ia_flag for i in range(len(label_pred))])
-    wr_nia = sum([label_pred[i] != label_true[i] and label_true[i] != ia_flag for i in range(len(label_pred))])
-    tot_ia = sum([label_true[i] == ia_flag for i in range(len(label_true))])
+    _, cc_ia, wr_nia, tot_ia = _classification_counts(label_pred, label_true, ia_flag)
 
-    if (cc_ia + penalty * wr_nia) > 0:
-        return (float(cc_ia) / (cc_ia + penalty * wr_nia)) * float(cc_ia) / tot_ia
-    else:
-        return 0
+    return _fom(cc_ia, wr_nia, tot_ia, penalty)
 
 
 def accuracy(label_pred: list, label_true: list):
@@ -124,9 +177,9 @@ def accuracy(label_pred: list, label_true: list):
 
     """
 
-    cc = sum([label_pred[i] == label_true[i] for i in range(len(label_pred))])
+    cc, _, _, _ = _classification_counts(label_pred, label_true)
 
-    return cc / len(label_pred)
+    return _accuracy(cc, len(label_pred))
 
 
 def get_snpcc_metric(label_pred: list, label_true: list, ia_flag=1,
@@ -155,13 +208,15 @@ def get_snpcc_metric(label_pred: list, label_true: list, ia_flag=1,
 
     """
 
-    calc_eff = efficiency(label_pred=label_pred,
-                          label_true=label_true, ia_flag=ia_flag)
-    calc_purity = purity(label_pred=label_pred,
-                         label_true=label_true, ia_flag=ia_flag)
-    calc_fom = fom(label_pred=label_pred,
-                   label_true=label_true, ia_flag=ia_flag, penalty=wpenalty)
-    calc_accuracy = accuracy(label_pred=label_pred, label_true=label_true)
+    # count outcomes once and share them between all metrics
+    cc, cc_ia, wr_nia, tot_ia = _classification_counts(label_pred=label_pred,
+                                                       label_true=label_true,
+                                                       ia_flag=ia_flag)
+
+    calc_eff = _efficiency(cc_ia, tot_ia)
+    calc_purity = _purity(cc_ia, wr_nia)
+    calc_fom = _fom(cc_ia, wr_nia, tot_ia, penalty=wpenalty)
+    calc_accuracy = _accuracy(cc, len(label_pred))
 
     metric_values = [calc_accuracy, calc_eff, calc_purity, calc_fom]
     metric_names = ['accuracy', 'efficiency', 'purity', 'fom']
@@ -176,11 +231,11 @@ def cosmo_metric(data: str, comp_data: str):
     data: str or pd.DataFrame
         Path to original data set or data frame from which 
         Fisher matrix will be calculated.
-        The data should be formated: ['id', 'z', 'mu', 'muerr'].
+        The data should be formated: ['id', 'z', 'mu', 'mu_err'].
     comp_data: str or pd.DataFrame
         Path to second data set or data frame to be compared 
         to the original data.
-        The data should be formated: ['id', 'z', 'mu', 'muerr'].   
+        The data should be formated: ['id', 'z', 'mu', 'mu_err'].   
  
     Returns
     -------
@@ -190,17 +245,19 @@ def cosmo_metric(data: str, comp_data: str):
         list of calculated metrics values for each element
     """
     from resspect.cosmo_metric_utils import compare_two_fishers
-    
-    # read distances
+
+    # useful columns only
+    columns = ['z', 'mu', 'mu_err']
+
+    # read distances, parsing only the columns needed
     if isinstance(data, str):
-        data = pd.read_csv(data)
-    
+        data = pd.read_csv(data, usecols=columns)
+
     if isinstance(comp_data, str):
-        comp_data = pd.read_csv(comp_data)
+        comp_data = pd.read_csv(comp_data, usecols=columns)
 
-    # get useful columns only
-    data1 = data[['z','mu','mu_err']].values
-    data2 = comp_data[['z','mu','mu_err']].values
+    data1 = data[columns].values
+    data2 = comp_data[columns].values
     
     # compare results from 2 fisher matrices
     fisher_diff = compare_two_fishers(data1, data2)